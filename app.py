@@ -3,33 +3,159 @@
 Stone to SGF — Go board photo to SGF converter
 Render.com deployment — single file, no API key needed.
 pip install opencv-python-headless numpy
+
+python app.py                    serve the web UI / API on $PORT
+python app.py convert DIR [-o]   batch-convert a folder of photos to .sgf
+python app.py track VIDEO [-o]   follow a live game from a fixed camera
+python app.py bench [-o F.json]  time / score the pipeline on synthetic boards
 """
 
-import http.server, json, os, base64, traceback
+import http.server, json, os, base64, traceback, signal, threading
+import argparse, io, sys, zipfile, hashlib, time, tracemalloc, gzip
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+# OpenCV reads its decoder pixel cap once, when it loads: set it from
+# MAX_MEGAPIXELS so formats whose header image_size can't read are capped too
+if float(os.environ.get('MAX_MEGAPIXELS', 50)) > 0:
+    os.environ.setdefault('OPENCV_IO_MAX_IMAGE_PIXELS',
+                          str(int(float(os.environ.get('MAX_MEGAPIXELS', 50)) * 1e6)))
 import cv2
 import numpy as np
 
 PORT = int(os.environ.get('PORT', 8080))
+# WORKERS=0 runs the pipeline inside the request thread (no process pool).
+WORKERS = int(os.environ.get('WORKERS', os.cpu_count() or 1))
+QUEUE_DEPTH = int(os.environ.get('QUEUE_DEPTH', 8))
+# OpenCV threads per process (the pool or request threads already run
+# images in parallel) and whether to use its SIMD/IPP code paths.
+CV_THREADS = int(os.environ.get('CV_THREADS', 1))
+CV_OPTIMIZED = os.environ.get('CV_OPTIMIZED', '1') != '0'
+# Long side (px) the pipeline works at; 0 keeps full resolution.
+MAX_SIDE = int(os.environ.get('MAX_SIDE', 1280))
+# Upload limits: body size for /analyze and /batch, decoded image size
+# (checked from the header before decoding), bytes of request bodies held
+# in memory at once across all requests, and read timeouts in seconds
+# (per chunk without progress / for a whole body).
+MAX_UPLOAD_MB = float(os.environ.get('MAX_UPLOAD_MB', 20))
+MAX_BATCH_MB = float(os.environ.get('MAX_BATCH_MB', 200))
+MAX_MEGAPIXELS = float(os.environ.get('MAX_MEGAPIXELS', 50))
+MAX_BUFFERED_MB = float(os.environ.get('MAX_BUFFERED_MB', 256))
+READ_TIMEOUT = float(os.environ.get('READ_TIMEOUT', 15))
+UPLOAD_TIMEOUT = float(os.environ.get('UPLOAD_TIMEOUT', 120))
+# Board size (lines per side); 0 infers 9, 13 or 19 from the photo.
+BOARD_SIZE = int(os.environ.get('BOARD_SIZE', 0))
+BOARD_SIZES = (9, 13, 19)
+# Side (px) of the square, perspective-corrected board image that grid
+# detection and classification run on; 0 uses the axis-aligned crop.
+RECTIFY_SIZE = int(os.environ.get('RECTIFY_SIZE', 760))
+# Grid fits scoring under GRID_MIN_CONFIDENCE (0-1) are retried with other
+# parameters for up to GRID_BUDGET_MS, then the photo is rejected.
+GRID_MIN_CONFIDENCE = float(os.environ.get('GRID_MIN_CONFIDENCE', 0.4))
+GRID_BUDGET_MS = float(os.environ.get('GRID_BUDGET_MS', 60))
+# Points classified with confidence (0-1) under this are listed as uncertain.
+LOW_CONFIDENCE = float(os.environ.get('LOW_CONFIDENCE', 0.25))
+# Result cache: entries kept in memory (0 disables), lifetime in seconds,
+# and an optional directory so results survive restarts, holding at most
+# CACHE_DISK_ENTRIES files.
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', 256))
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 24 * 3600))
+CACHE_DIR = os.environ.get('CACHE_DIR') or None
+CACHE_DISK_ENTRIES = int(os.environ.get('CACHE_DISK_ENTRIES', 10000))
 
 # ---------------------------------------------------------------------------
 # Computer Vision Pipeline
 # ---------------------------------------------------------------------------
 
-def cluster_lines(positions, min_gap=8):
-    if not positions:
-        return []
-    positions = sorted(positions)
-    clusters = [[positions[0]]]
-    for p in positions[1:]:
-        if p - clusters[-1][-1] < min_gap:
-            clusters[-1].append(p)
-        else:
-            clusters.append([p])
-    return [int(np.mean(c)) for c in clusters]
+def image_size(img_bytes):
+    """(width, height) from a JPEG / PNG / WEBP header, or None."""
+    b = img_bytes
+    if b[:8] == b'\x89PNG\r\n\x1a\n' and len(b) >= 24:
+        return int.from_bytes(b[16:20], 'big'), int.from_bytes(b[20:24], 'big')
+    if b[:2] == b'\xff\xd8':
+        i = 2
+        while i + 9 < len(b):
+            if b[i] != 0xFF:
+                return None
+            marker = b[i + 1]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+                i += 1 if marker == 0xFF else 2
+                continue
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                return (int.from_bytes(b[i + 7:i + 9], 'big'),
+                        int.from_bytes(b[i + 5:i + 7], 'big'))
+            i += 2 + int.from_bytes(b[i + 2:i + 4], 'big')
+        return None
+    if b[:4] == b'RIFF' and b[8:12] == b'WEBP' and len(b) >= 30:
+        chunk = b[12:16]
+        if chunk == b'VP8 ':
+            return (int.from_bytes(b[26:28], 'little') & 0x3FFF,
+                    int.from_bytes(b[28:30], 'little') & 0x3FFF)
+        if chunk == b'VP8L':
+            bits = int.from_bytes(b[21:25], 'little')
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b'VP8X':
+            return (int.from_bytes(b[24:27], 'little') + 1,
+                    int.from_bytes(b[27:30], 'little') + 1)
+    return None
 
 
-def detect_board_region(gray):
-    """Find the board bounding box. Falls back to a tight crop."""
+class TooLarge(ValueError):
+    pass
+
+
+def check_image_size(img_bytes, max_megapixels=MAX_MEGAPIXELS):
+    """Header (width, height), or None; TooLarge if over the pixel limit."""
+    size = image_size(img_bytes)
+    if size and max_megapixels and size[0] * size[1] > max_megapixels * 1e6:
+        raise TooLarge(f"Image is {size[0]}x{size[1]} px; the limit is "
+                       f"{max_megapixels:g} megapixels.")
+    return size
+
+
+def decode_gray(img_bytes, max_side=MAX_SIDE):
+    """
+    Decode straight to grayscale at roughly max_side px on the long side.
+    JPEGs are shrunk inside the decoder (1/2, 1/4, 1/8 DCT scaling) so the
+    full-size bitmap is never built; the remainder is an INTER_AREA resize.
+    Images over MAX_MEGAPIXELS by their header are refused undecoded;
+    other formats are held to it by OpenCV's own decoder limit.
+    Returns (gray, scale) with scale = working size / original size.
+    """
+    arr = np.frombuffer(img_bytes, dtype=np.uint8)
+    size = check_image_size(img_bytes)
+    flag = cv2.IMREAD_GRAYSCALE
+    if max_side and size:
+        for f, reduced in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                           (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                           (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+            if max(size) // f >= max_side:
+                flag = reduced
+                break
+    try:
+        gray = cv2.imdecode(arr, flag) if arr.size else None
+    except cv2.error as e:
+        if 'CV_IO_MAX_IMAGE_PIXELS' in str(e):
+            raise TooLarge(f"Image is over the {MAX_MEGAPIXELS:g} megapixel limit.")
+        gray = None
+    if gray is None:
+        raise ValueError("Could not decode image. Please use JPEG, PNG, or WEBP.")
+    full_side = max(size) if size else max(gray.shape)
+    gray = shrink(gray, max_side)
+    return gray, max(gray.shape) / full_side
+
+
+def shrink(gray, max_side=MAX_SIDE):
+    """INTER_AREA downscale so the long side is at most max_side (0 = off)."""
+    if max_side and max(gray.shape) > max_side:
+        k = max_side / max(gray.shape)
+        gray = cv2.resize(gray, None, fx=k, fy=k, interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def _board_outline(gray):
+    """(contour, 4-point approximation) of the board edge, or None."""
     edges = cv2.Canny(gray, 50, 150)
     contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     contours = sorted(contours, key=cv2.contourArea, reverse=True)
@@ -42,98 +168,737 @@ def detect_board_region(gray):
         if len(approx) == 4:
             x, y, w, h = cv2.boundingRect(contour)
             if 0.7 < w / h < 1.3:
-                return x, y, w, h
+                return contour, approx
+    return None
+
+
+def detect_board_region(gray):
+    """Find the board bounding box. Falls back to a tight crop."""
+    outline = _board_outline(gray)
+    if outline is not None:
+        return cv2.boundingRect(outline[0])
+    h_img, w_img = gray.shape
     m = int(min(w_img, h_img) * 0.03)
     return m, m, w_img - 2*m, h_img - 2*m
 
 
-def detect_grid(board_gray):
-    """Return 19-element h_grid and v_grid (pixel positions of each line)."""
-    h, w = board_gray.shape
-    edges = cv2.Canny(board_gray, 40, 120)
-    lines = cv2.HoughLinesP(edges, 1, np.pi/180,
-                             threshold=80,
-                             minLineLength=int(min(h, w) * 0.4),
-                             maxLineGap=5)
-    h_pos, v_pos = [], []
-    if lines is not None:
-        for line in lines:
-            x1, y1, x2, y2 = line[0]
-            angle = abs(np.degrees(np.arctan2(y2 - y1, x2 - x1)))
-            if angle < 5:
-                h_pos.append((y1 + y2) // 2)
-            elif angle > 85:
-                v_pos.append((x1 + x2) // 2)
-    margin = int(min(h, w) * 0.02)
-    h_inner = [x for x in cluster_lines(h_pos) if margin < x < h - margin]
-    v_inner = [x for x in cluster_lines(v_pos) if margin < x < w - margin]
-
-    def make_grid(inner, size):
-        if len(inner) >= 2:
-            first, last = inner[0], inner[-1]
+def detect_board_corners(gray):
+    """
+    Board corners as float32 [tl, tr, br, bl]. Uses the quadrilateral
+    approxPolyDP finds, so a photo taken at an angle keeps its true shape;
+    falls back to the same tight crop as detect_board_region.
+    """
+    outline = _board_outline(gray)
+    if outline is None:
+        x, y, w, h = detect_board_region(gray)
+        return np.float32([[x, y], [x + w, y], [x + w, y + h], [x, y + h]])
+    pts = outline[1].reshape(4, 2).astype(np.float32)
+    s, d = pts.sum(axis=1), pts[:, 1] - pts[:, 0]
+    return pts[[np.argmin(s), np.argmin(d), np.argmax(s), np.argmax(d)]]
+
+
+def _square_homography(corners, size, border):
+    lo, hi = border, size - 1 - border
+    square = np.float32([[lo, lo], [hi, lo], [hi, hi], [lo, hi]])
+    return cv2.getPerspectiveTransform(corners, square)
+
+
+def board_view(gray, transform=None, rectify_size=RECTIFY_SIZE):
+    """
+    The board as an image of its own, plus the transform that produced it
+    so later frames from the same camera can skip detection: a homography
+    onto a rectify_size square, or an (x, y, w, h) crop if rectify_size is 0.
+    Rectified boards cost the same downstream whatever the photo size.
+    """
+    if transform is None and not rectify_size:
+        transform = detect_board_region(gray)
+    if transform is None:
+        # The outline found is either the wood edge or the outermost grid
+        # line. Warp with a ~half-cell border first: if that border is wood
+        # coloured it was the grid line and the border keeps edge stones in
+        # view; if it is much darker it was the table, so drop the border
+        # (the grid fit allows lines right at the edge, as with the crop).
+        corners = detect_board_corners(gray)
+        border = rectify_size // 32
+        transform = _square_homography(corners, rectify_size, border)
+        board = cv2.warpPerspective(gray, transform, (rectify_size,) * 2)
+        edge = np.concatenate([board[:border].ravel(), board[-border:].ravel(),
+                               board[:, :border].ravel(), board[:, -border:].ravel()])
+        inner = board[2 * border:-2 * border, 2 * border:-2 * border]
+        if np.median(edge) >= 0.7 * np.median(inner):
+            return board, transform
+        transform = _square_homography(corners, rectify_size, 0)
+    if isinstance(transform, np.ndarray):
+        size = rectify_size or RECTIFY_SIZE
+        return cv2.warpPerspective(gray, transform, (size, size),
+                                   flags=cv2.INTER_LINEAR), transform
+    bx, by, bw, bh = transform
+    return gray[by:by + bh, bx:bx + bw], transform
+
+
+def line_profiles(board_gray, k):
+    """
+    Row and column profiles of the thin dark lines: a black-hat with a k-px
+    kernel keeps only dark features narrower than k, averaged along each
+    line direction. Stones are too wide to show up.
+    """
+    return tuple(cv2.morphologyEx(board_gray, cv2.MORPH_BLACKHAT, kernel).mean(axis=axis)
+                 for kernel, axis in ((np.ones((k, 1), np.uint8), 1),
+                                      (np.ones((1, k), np.uint8), 0)))
+
+
+def infer_board_size(profiles):
+    """
+    Pick 9, 13 or 19 from the line profiles: a board of n lines puts its
+    strongest frequency at about n cycles across the crop. The smallest
+    size within half of the best score wins, since a 9x9 grid also rings
+    at its second harmonic, next to 19.
+    """
+    spectrum = np.zeros(max(BOARD_SIZES) + 2)
+    for profile in profiles:
+        power = np.abs(np.fft.rfft(profile - profile.mean()))[:len(spectrum)]
+        spectrum[:len(power)] += power
+    scores = {n: spectrum[n - 1:n + 2].max() for n in BOARD_SIZES}
+    best = max(scores.values())
+    return min(n for n in BOARD_SIZES if scores[n] >= 0.5 * best)
+
+
+def fit_lines(profile, n, step=0.25):
+    """
+    The n evenly spaced lines that best fit a line profile: spacings from
+    extent/(n+2) to extent/(n-1) (whole px, then `step` px around the best)
+    at every whole-pixel offset are scored by the mean profile under their
+    lines. Returns (positions, confidence); confidence is 1 - the mean
+    profile midway between the lines over the median on them (a median,
+    so a couple of strong edges can't vouch for a grid of empty lines).
+    """
+    extent = len(profile)
+    profile = cv2.GaussianBlur(profile.astype(np.float32).reshape(-1, 1), (1, 5), 1).ravel()
+    idx = np.arange(n)
+
+    def search(spacings, best=(-1.0, None, 0.0)):
+        # Offsets keep every line inside the profile, so pos is in [0, extent)
+        for spacing in spacings:
+            pos = np.rint(np.arange(extent - (n - 1) * spacing - 1)[:, None]
+                          + idx * spacing).astype(np.intp)
+            if not len(pos):
+                break
+            scores = profile[pos].mean(axis=1)
+            i = int(np.argmax(scores))
+            if scores[i] > best[0]:
+                best = (scores[i], pos[i], spacing)
+        return best
+
+    lo, hi = extent / (n + 2), extent / (n - 1)
+    best = search(np.arange(lo, hi, 1.0))
+    fine = np.arange(best[2] - 1, best[2] + 1, step)
+    _, lines, spacing = search(fine[(fine >= lo) & (fine < hi) & (fine > 0)], best)
+    if lines is None:   # fewer pixels than lines
+        return np.linspace(0, extent - 1, n).astype(int).tolist(), 0.0
+    mid = np.rint(lines[:-1] + spacing / 2).astype(np.intp)
+    on, off = np.median(profile[lines]), profile[mid].mean()
+    confidence = float(np.clip(1 - off / on, 0, 1)) if on > 0 else 0.0
+    return lines.tolist(), confidence
+
+
+def detect_grid(board_gray, size=None, budget_ms=GRID_BUDGET_MS):
+    """
+    Return size-element h_grid and v_grid (pixel positions of each line)
+    and the fit's confidence; with size=None the board size is inferred.
+    A fit under GRID_MIN_CONFIDENCE is retried with wider then narrower
+    black-hat kernels (and, when inferring, the other sizes) until one
+    passes or budget_ms runs out; the best fit seen is returned.
+    """
+    t0 = time.perf_counter()
+    side = min(board_gray.shape)
+    best = None
+    for k in (side // 40, side // 24, side // 64):
+        profiles = line_profiles(board_gray, max(3, k))
+        if size:
+            sizes = [size]
         else:
-            first, last = int(size * 0.05), int(size * 0.95)
-        return [int(first + i * (last - first) / 18) for i in range(19)]
+            guess = infer_board_size(profiles)
+            sizes = [guess] + [n for n in BOARD_SIZES if n != guess]
+        for n in sizes:
+            (h_grid, h_conf), (v_grid, v_conf) = (fit_lines(p, n) for p in profiles)
+            if best is None or min(h_conf, v_conf) > best[2]:
+                best = (h_grid, v_grid, min(h_conf, v_conf))
+            if (best[2] >= GRID_MIN_CONFIDENCE
+                    or (time.perf_counter() - t0) * 1000 > budget_ms):
+                return best
+    return best
+
+
+EMPTY, BLACK, WHITE = 0, 1, 2
+COORDS = 'abcdefghijklmnopqrs'
+
+
+def window_sums(mask, h_grid, v_grid, window):
+    """
+    Count of set pixels (or, for a grey image, sum of levels) in the
+    (2*window+1)^2 box around every grid point, clipped to the image, from
+    one integral image. Returns (counts, box_areas), both shaped
+    (len(h_grid), len(v_grid)).
+    """
+    bh, bw = mask.shape
+    ry = np.asarray(h_grid, dtype=np.int64)
+    cx = np.asarray(v_grid, dtype=np.int64)
+    y1 = np.clip(ry - window, 0, bh)[:, None]
+    y2 = np.clip(ry + window + 1, 0, bh)[:, None]
+    x1 = np.clip(cx - window, 0, bw)[None, :]
+    x2 = np.clip(cx + window + 1, 0, bw)[None, :]
+    ii = cv2.integral(mask.view(np.uint8) if mask.dtype == bool else mask)
+    counts = ii[y2, x2] - ii[y1, x2] - ii[y2, x1] + ii[y1, x1]
+    return counts, np.maximum(y2 - y1, 0) * np.maximum(x2 - x1, 0)
+
+
+def sample_window(h_grid):
+    """Adaptive window: ~35% of cell size, minimum 4px."""
+    cell_size = (h_grid[-1] - h_grid[0]) / (len(h_grid) - 1)
+    return max(4, int(cell_size * 0.35))
 
-    return make_grid(h_inner, h), make_grid(v_inner, w)
+
+def classify_grid(board_gray, h_grid, v_grid, window,
+                  dark_thresh=120, bright_thresh=195, stone_frac=0.5, gain=None):
+    """
+    Classify every (h_grid, v_grid) point from the window around it:
+    black if more than stone_frac of its pixels are dark (< dark_thresh),
+    else white if more than stone_frac are bright (> bright_thresh), else
+    empty (only the thin grid-line cross is dark, ~10%).
+    Window sums come from integral images of the dark and bright masks,
+    so the cost is one pass over the board instead of one slice per point.
+    gain (float32, board-sized) rescales the board first, see calibrate.
+    Returns an int8 array of EMPTY / BLACK / WHITE, shape (len(h), len(v)),
+    and a float32 confidence per point in 0..1: how far the deciding
+    dark / bright fraction is from stone_frac, relative to its range.
+    """
+    if gain is not None:
+        board_gray = cv2.multiply(board_gray, gain, dtype=cv2.CV_8U)
+    dark, total = window_sums(board_gray < dark_thresh, h_grid, v_grid, window)
+    bright, _ = window_sums(board_gray > bright_thresh, h_grid, v_grid, window)
+    total = np.maximum(total, 1)
+    dark, bright = dark / total, bright / total
+    is_black = dark > stone_frac
+    is_white = ~is_black & (bright > stone_frac)
+    labels = np.zeros(total.shape, dtype=np.int8)
+    labels[is_black] = BLACK
+    labels[is_white] = WHITE
+    margin = np.where(is_black, (dark - stone_frac) / (1 - stone_frac),
+             np.where(is_white, (bright - stone_frac) / (1 - stone_frac),
+                      (stone_frac - np.maximum(dark, bright)) / stone_frac))
+    return labels, np.clip(margin, 0, 1).astype(np.float32)
 
 
-def classify_intersection(board_gray, ry, cx, window,
-                           dark_thresh=120, bright_thresh=195, stone_frac=0.5):
+def classify_points(board_gray, h_grid, v_grid, window, points,
+                    dark_thresh=120, bright_thresh=195, stone_frac=0.5, gain=None):
     """
-    Black stone:  >50% of window pixels are dark  (< dark_thresh)
-    White stone:  >50% of window pixels are bright (> bright_thresh)
-    Empty:        neither — only the thin grid-line cross is dark (~10%)
+    classify_grid's labels for just the (row, col) grid points listed,
+    from one window slice each instead of integral images of the whole
+    board; for a few points per frame this is far cheaper.
     """
     bh, bw = board_gray.shape
-    y1, y2 = max(0, ry - window), min(bh, ry + window + 1)
-    x1, x2 = max(0, cx - window), min(bw, cx + window + 1)
-    region = board_gray[y1:y2, x1:x2]
-    total = region.size
-    if total == 0:
-        return 'empty'
-    if np.sum(region < dark_thresh) / total > stone_frac:
-        return 'black'
-    if np.sum(region > bright_thresh) / total > stone_frac:
-        return 'white'
-    return 'empty'
-
-
-def image_to_sgf(img_bytes):
-    COORDS = 'abcdefghijklmnopqrs'
-    arr = np.frombuffer(img_bytes, dtype=np.uint8)
-    img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise ValueError("Could not decode image. Please use JPEG, PNG, or WEBP.")
+    labels = np.zeros(len(points), dtype=np.int8)
+    for i, (r, c) in enumerate(points):
+        ry, cx = h_grid[r], v_grid[c]
+        y1, y2 = max(0, ry - window), min(bh, ry + window + 1)
+        x1, x2 = max(0, cx - window), min(bw, cx + window + 1)
+        region = board_gray[y1:y2, x1:x2]
+        if gain is not None:
+            region = cv2.multiply(region, gain[y1:y2, x1:x2], dtype=cv2.CV_8U)
+        total = max(region.size, 1)
+        if np.count_nonzero(region < dark_thresh) / total > stone_frac:
+            labels[i] = BLACK
+        elif np.count_nonzero(region > bright_thresh) / total > stone_frac:
+            labels[i] = WHITE
+    return labels
+
+
+def level_thresholds(levels):
+    """
+    (dark_thresh, bright_thresh) from the mean grey level of every point:
+    1-D k-means into black / empty / white, thresholds halfway between the
+    clusters. A colour with no stones on the board leaves its cluster up
+    against the empty one; a fixed ratio of the empty level is used then.
+    """
+    levels = levels.ravel()
+    centers = np.percentile(levels, [2, 50, 98])
+    for _ in range(10):
+        nearest = np.abs(levels[:, None] - centers).argmin(axis=1)
+        counts = np.bincount(nearest, minlength=3)
+        centers = np.where(counts > 0, np.bincount(nearest, levels, 3)
+                           / np.maximum(counts, 1), centers)
+    black, empty, white = np.sort(centers)
+    dark = (black + empty) / 2 if empty - black > 0.35 * empty else 0.8 * empty
+    bright = (max((empty + white) / 2, 1.25 * empty) if white - empty > 0.25 * empty
+              else 1.33 * empty)
+    return float(dark), float(bright)
+
+
+def calibrate(board_gray, h_grid, v_grid, window, rounds=2):
+    """
+    classify_grid keyword arguments fitted to this board instead of fixed
+    grey levels. Thresholds come from level_thresholds; then a quadratic
+    brightness surface is fitted to the levels of the points that look
+    empty, the levels are flattened by it and the thresholds refitted, so
+    a light falloff across the photo doesn't turn the dim side black or
+    the bright side white. The surface becomes a per-pixel gain.
+    """
+    sums, area = window_sums(board_gray, h_grid, v_grid, window)
+    levels = sums / np.maximum(area, 1)
+    dark, bright = level_thresholds(levels)
+    terms = lambda r, c: [np.ones_like(r * c), r, c, r * r, c * c, r * c]
+    rows, cols = np.indices(levels.shape)
+    flat, coef = levels, None
+    for _ in range(rounds):
+        empty = (flat > dark) & (flat < bright)
+        if empty.sum() < 6:
+            break
+        coef, *_ = np.linalg.lstsq(np.stack(terms(rows[empty], cols[empty]), axis=1),
+                                   levels[empty], rcond=None)
+        base = float(np.median(levels[empty]))
+        flat = levels * base / np.maximum(sum(k * t for k, t in zip(coef, terms(rows, cols))), 1)
+        dark, bright = level_thresholds(flat)
+    params = {'dark_thresh': dark, 'bright_thresh': bright}
+    if coef is not None:
+        # Evaluate on a coarse pixel grid (rows / cols as fractional grid
+        # indices) and upsample: the surface is smooth
+        bh, bw = board_gray.shape
+        step = 8
+        r = ((np.arange(0, bh + step, step) - h_grid[0])
+             / max((h_grid[-1] - h_grid[0]) / (len(h_grid) - 1), 1))[:, None]
+        c = ((np.arange(0, bw + step, step) - v_grid[0])
+             / max((v_grid[-1] - v_grid[0]) / (len(v_grid) - 1), 1))[None, :]
+        lit = np.maximum(sum(k * t for k, t in zip(coef, terms(r, c))), 1)
+        gain = cv2.resize((base / lit).astype(np.float32),
+                          (c.shape[1] * step, r.shape[0] * step))
+        params['gain'] = np.ascontiguousarray(gain[:bh, :bw])
+    return params
+
+
+class BoardState:
+    """
+    One recognised position: an int8 (size, size) array of EMPTY / BLACK /
+    WHITE, rows top to bottom, plus optional per-point confidence and the
+    grid line positions (px in the board image) it was read from, with the
+    grid fit's confidence.
+    """
+
+    __slots__ = ('stones', 'confidence', 'h_grid', 'v_grid', 'scale', 'grid_confidence')
+    MAGIC = b'GB'
+    DIAGRAM = '.XO'
+
+    def __init__(self, stones, confidence=None, h_grid=None, v_grid=None,
+                 scale=1.0, grid_confidence=None):
+        self.stones = np.asarray(stones, dtype=np.int8)
+        self.confidence = confidence
+        self.h_grid = [int(y) for y in h_grid] if h_grid is not None else None
+        self.v_grid = [int(x) for x in v_grid] if v_grid is not None else None
+        self.scale = float(scale)
+        self.grid_confidence = grid_confidence
 
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    bx, by, bw, bh = detect_board_region(gray)
-    board_gray = gray[by:by + bh, bx:bx + bw]
-    h_grid, v_grid = detect_grid(board_gray)
-
-    # Adaptive window: ~35% of cell size, minimum 4px
-    cell_size = (h_grid[-1] - h_grid[0]) / 18
-    window = max(4, int(cell_size * 0.35))
-
-    black_stones, white_stones = [], []
-    for row_i in range(19):
-        for col_i in range(19):
-            result = classify_intersection(
-                board_gray, h_grid[row_i], v_grid[col_i], window)
-            coord = f'[{COORDS[col_i]}{COORDS[row_i]}]'
-            if result == 'black':
-                black_stones.append(coord)
-            elif result == 'white':
-                white_stones.append(coord)
-
-    if not black_stones and not white_stones:
+    @property
+    def size(self):
+        return self.stones.shape[0]
+
+    @property
+    def black(self):
+        return int(np.count_nonzero(self.stones == BLACK))
+
+    @property
+    def white(self):
+        return int(np.count_nonzero(self.stones == WHITE))
+
+    def to_sgf(self, moves=()):
+        """SGF with the position as AB/AW setup, then any (color, r, c) moves."""
+        def points(color):
+            return ''.join(f'[{COORDS[c]}{COORDS[r]}]'
+                           for r, c in zip(*np.nonzero(self.stones == color)))
+        ab, aw = points(BLACK), points(WHITE)
+        setup = (f'AB{ab}' if ab else '') + (f'AW{aw}' if aw else '')
+        body = ''.join(f'\n;{"B" if color == BLACK else "W"}[{COORDS[c]}{COORDS[r]}]'
+                       for color, r, c in moves)
+        return (f"(;FF[4]GM[1]SZ[{self.size}]CA[UTF-8]AP[Stone-to-SGF-CV:1.0]\n"
+                f";{setup}{body})")
+
+    def to_json(self):
+        out = {'size': self.size,
+               'board': [''.join(self.DIAGRAM[v] for v in row) for row in self.stones],
+               'black': self.black, 'white': self.white,
+               'scale': round(self.scale, 4),
+               'grid': {'h': self.h_grid, 'v': self.v_grid}}
+        if self.grid_confidence is not None:
+            out['grid']['confidence'] = round(self.grid_confidence, 3)
+        if self.confidence is not None:
+            out['confidence'] = np.round(self.confidence, 3).tolist()
+            out['uncertain'] = self.uncertain()
+        return out
+
+    def uncertain(self, below=LOW_CONFIDENCE):
+        """SGF coordinates of the points read with confidence under `below`."""
+        if self.confidence is None:
+            return []
+        return [f'{COORDS[c]}{COORDS[r]}'
+                for r, c in zip(*np.nonzero(np.asarray(self.confidence) < below))]
+
+    @classmethod
+    def from_json(cls, data):
+        stones = [[cls.DIAGRAM.index(ch) for ch in row] for row in data['board']]
+        conf = data.get('confidence')
+        return cls(stones, np.asarray(conf, np.float32) if conf is not None else None,
+                   data['grid']['h'], data['grid']['v'], data.get('scale', 1.0),
+                   data['grid'].get('confidence'))
+
+    def to_bytes(self):
+        """b'GB', size byte, then 2 bits per point, row-major, 4 per byte."""
+        flat = self.stones.ravel().astype(np.uint8)
+        flat = np.concatenate([flat, np.zeros(-len(flat) % 4, np.uint8)]).reshape(-1, 4)
+        packed = flat[:, 0] | flat[:, 1] << 2 | flat[:, 2] << 4 | flat[:, 3] << 6
+        return self.MAGIC + bytes([self.size]) + packed.astype(np.uint8).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[:2] != cls.MAGIC:
+            raise ValueError("Not a packed board.")
+        size = data[2]
+        packed = np.frombuffer(data, np.uint8, offset=3)
+        flat = np.stack([packed & 3, packed >> 2 & 3, packed >> 4 & 3, packed >> 6], axis=1)
+        return cls(flat.ravel()[:size * size].reshape(size, size))
+
+    def to_diagram(self):
+        """Text board, row 1 at the bottom, columns A-T without I."""
+        cols = 'ABCDEFGHJKLMNOPQRST'[:self.size]
+        stars = set(star_points(self.size))
+        lines = ['   ' + ' '.join(cols)]
+        for r, row in enumerate(self.stones):
+            cells = [self.DIAGRAM[v] if v or (r, c) not in stars else '+'
+                     for c, v in enumerate(row)]
+            lines.append(f'{self.size - r:>2} ' + ' '.join(cells))
+        return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def timed(timings, stage):
+    """Add the block's wall time (ms) to timings[stage] when timings is a dict."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = (timings.get(stage, 0.0)
+                              + (time.perf_counter() - t0) * 1000)
+
+
+def read_board(img_bytes, max_side=MAX_SIDE, timings=None,
+               rectify_size=RECTIFY_SIZE, size=BOARD_SIZE):
+    """The CV pipeline: encoded image -> BoardState (size 0 = infer)."""
+    with timed(timings, 'decode'):
+        gray, scale = decode_gray(img_bytes, max_side)
+    with timed(timings, 'board'):
+        board_gray, _ = board_view(gray, rectify_size=rectify_size)
+    with timed(timings, 'grid'):
+        h_grid, v_grid, grid_confidence = detect_grid(board_gray, size)
+    if grid_confidence < GRID_MIN_CONFIDENCE:
+        raise ValueError(
+            "Could not find the board grid. Make sure the whole board is in "
+            "the photo, in focus and evenly lit.")
+
+    with timed(timings, 'classify'):
+        window = sample_window(h_grid)
+        labels, confidence = classify_grid(
+            board_gray, h_grid, v_grid, window,
+            **calibrate(board_gray, h_grid, v_grid, window))
+
+    if not labels.any():
         raise ValueError(
             "No stones detected. Make sure the image shows a clear "
             "top-down view of a Go board with good contrast.")
+    return BoardState(labels, confidence, h_grid, v_grid, scale, grid_confidence)
+
+
+def parse_board_size(text):
+    """'auto' -> 0 (infer), else the number of lines per side."""
+    if text == 'auto':
+        return 0
+    if text.isdigit() and 5 <= int(text) <= len(COORDS):
+        return int(text)
+    raise ValueError(f"Board size must be 'auto' or 5-{len(COORDS)}.")
+
+
+def image_to_sgf(img_bytes, max_side=MAX_SIDE, timings=None,
+                 rectify_size=RECTIFY_SIZE, size=BOARD_SIZE):
+    state = read_board(img_bytes, max_side, timings, rectify_size, size)
+    with timed(timings, 'sgf'):
+        return {'sgf': state.to_sgf(), 'black': state.black,
+                'white': state.white, 'scale': round(state.scale, 4),
+                'uncertain': state.uncertain()}
+
+
+# ---------------------------------------------------------------------------
+# Synthetic boards
+# ---------------------------------------------------------------------------
+
+def star_points(size):
+    """Hoshi: the corner points, plus tengen on odd sizes and sides on 19x19."""
+    edge = 2 if size < 13 else 3
+    far = size - 1 - edge
+    pts = [(r, c) for r in (edge, far) for c in (edge, far)]
+    if size % 2:
+        mid = size // 2
+        pts.append((mid, mid))
+        if size >= 19:
+            pts += [(edge, mid), (mid, edge), (mid, far), (far, mid)]
+    return pts
+
+
+def render_board(size=19, width=1200, height=None, stones=None, fill=0.3,
+                 rotation=0.0, perspective=0.0, noise=0.0, lighting=0.0,
+                 seed=None):
+    """
+    Draw a synthetic photo of a size x size board on a table.
+    Returns (bgr_image, labels): labels is the int8 EMPTY/BLACK/WHITE grid
+    actually drawn, rows top to bottom as image_to_sgf reads them.
+    rotation: degrees; perspective: max corner shift as a fraction of the
+    board side; noise: Gaussian sigma in grey levels; lighting: 0..1
+    strength of a linear brightness falloff across the photo.
+    """
+    rng = np.random.default_rng(seed)
+    height = height or width
+    if stones is None:
+        stones = rng.choice([EMPTY, BLACK, WHITE], (size, size),
+                            p=[1 - fill, fill / 2, fill / 2])
+    stones = np.asarray(stones, dtype=np.int8)
+
+    side = int(min(width, height) * 0.8)
+    cell = side / (size - 1 + 1.2)
+    margin = 0.6 * cell
+    board = np.empty((side, side, 3), np.uint8)
+    board[:] = (92, 170, 218)
+    line_w = max(1, round(cell / 25))
+    pos = [int(round(margin + i * cell)) for i in range(size)]
+    for p in pos:
+        cv2.line(board, (pos[0], p), (pos[-1], p), (30, 30, 30), line_w, cv2.LINE_AA)
+        cv2.line(board, (p, pos[0]), (p, pos[-1]), (30, 30, 30), line_w, cv2.LINE_AA)
+    for r, c in star_points(size):
+        cv2.circle(board, (pos[c], pos[r]), max(2, int(cell * 0.08)),
+                   (30, 30, 30), -1, cv2.LINE_AA)
+    radius = int(cell * 0.47)
+    for r, c in zip(*np.nonzero(stones)):
+        center = (pos[c], pos[r])
+        if stones[r, c] == BLACK:
+            cv2.circle(board, center, radius, (22, 22, 22), -1, cv2.LINE_AA)
+            cv2.circle(board, (center[0] - radius // 3, center[1] - radius // 3),
+                       max(1, radius // 5), (70, 70, 70), -1, cv2.LINE_AA)
+        else:
+            cv2.circle(board, center, radius, (236, 236, 232), -1, cv2.LINE_AA)
+            cv2.circle(board, center, radius, (150, 150, 150), 1, cv2.LINE_AA)
+
+    img = np.empty((height, width, 3), np.uint8)
+    img[:] = (48, 56, 64)
+    half = side / 2
+    src = np.float32([[0, 0], [side, 0], [side, side], [0, side]])
+    corners = np.float32([[-half, -half], [half, -half], [half, half], [-half, half]])
+    corners += rng.uniform(-perspective, perspective, corners.shape) * side
+    t = np.radians(rotation)
+    rot = np.float32([[np.cos(t), -np.sin(t)], [np.sin(t), np.cos(t)]])
+    dst = corners @ rot.T + np.float32([width / 2, height / 2])
+    M = cv2.getPerspectiveTransform(src, dst.astype(np.float32))
+    cv2.warpPerspective(board, M, (width, height), dst=img,
+                        flags=cv2.INTER_LINEAR,
+                        borderMode=cv2.BORDER_TRANSPARENT)
+
+    if lighting or noise:
+        out = img.astype(np.float32)
+        if lighting:
+            a = rng.uniform(0, 2 * np.pi)
+            yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+            ramp = xx / width * np.cos(a) + yy / height * np.sin(a)
+            ramp = (ramp - ramp.min()) / max(float(np.ptp(ramp)), 1e-6)
+            out *= (1 - lighting * ramp)[..., None]
+        if noise:
+            out += rng.normal(0, noise, out.shape).astype(np.float32)
+        img = np.clip(out, 0, 255).astype(np.uint8)
+    return img, stones
+
+
+# ---------------------------------------------------------------------------
+# Live tracking (video / camera)
+# ---------------------------------------------------------------------------
 
-    sgf = (f"(;FF[4]GM[1]SZ[19]CA[UTF-8]AP[Stone-to-SGF-CV:1.0]\n"
-           f";AB{''.join(black_stones)}AW{''.join(white_stones)})")
-    return sgf, len(black_stones), len(white_stones)
+class BoardTracker:
+    """
+    Turns frames from a fixed camera into a move sequence.
+
+    Board (and its homography) and grid are detected once and reused until
+    most intersections change at the same time (board or camera moved).
+    On every other frame only the intersections whose pixels differ from
+    when they were last read are reclassified. The position is committed
+    once no intersection has changed for `quiet_frames` frames, so a hand
+    over the board is ignored; stones that appeared since the last commit
+    become moves.
+    The board size (0 = infer) is fixed by the first detection.
+    """
+
+    def __init__(self, quiet_frames=8, diff_thresh=30, change_frac=0.25,
+                 moved_frac=0.5, size=BOARD_SIZE):
+        self.size = size
+        self.quiet_frames = quiet_frames
+        self.diff_thresh = diff_thresh
+        self.change_frac = change_frac
+        self.moved_frac = moved_frac
+        self.geometry = None   # (transform, h_grid, v_grid, window)
+        self.calib = None      # classify_grid thresholds / gain for it
+        self.frame_shape = None
+        self.ref = None        # board pixels each point was last read from
+        self.observed = None   # latest label per point
+        self.quiet = 0         # frames since any point last changed
+        self.setup = None      # first committed position
+        self.board = None      # last committed position
+        self.moves = []        # (color, row, col)
+        self.redetections = 0
+
+    def update(self, gray):
+        """Feed one grayscale frame; returns the moves it committed."""
+        if self.geometry is None or gray.shape != self.frame_shape:
+            self._detect(gray)
+            return []
+        transform, h_grid, v_grid, window = self.geometry
+        board_gray, _ = board_view(gray, transform)
+        diff = cv2.absdiff(board_gray, self.ref) > self.diff_thresh
+        counts, total = window_sums(diff, h_grid, v_grid, window)
+        changed = counts > self.change_frac * total
+        if changed.mean() > self.moved_frac:
+            self._detect(gray)
+            return []
+        if changed.any():
+            self.quiet = 0
+            self.observed[changed] = classify_points(
+                board_gray, h_grid, v_grid, window, np.argwhere(changed), **self.calib)
+            rows, cols = board_gray.shape
+            for r, c in zip(*np.nonzero(changed)):
+                ry, cx = h_grid[r], v_grid[c]
+                y1, y2 = max(0, ry - window), min(rows, ry + window + 1)
+                x1, x2 = max(0, cx - window), min(cols, cx + window + 1)
+                self.ref[y1:y2, x1:x2] = board_gray[y1:y2, x1:x2]
+            return []
+        self.quiet += 1
+        if self.quiet == self.quiet_frames:
+            return self._commit()
+        return []
+
+    def _detect(self, gray):
+        board_gray, transform = board_view(gray)
+        h_grid, v_grid, grid_confidence = detect_grid(board_gray, self.size)
+        if grid_confidence < GRID_MIN_CONFIDENCE:
+            # No board in view yet, or a hand over it: try the next frame
+            self.geometry = None
+            return
+        self.size = len(h_grid)
+        window = sample_window(h_grid)
+        self.geometry = (transform, h_grid, v_grid, window)
+        self.frame_shape = gray.shape
+        self.ref = board_gray.copy()
+        self.calib = calibrate(board_gray, h_grid, v_grid, window)
+        self.observed, _ = classify_grid(board_gray, h_grid, v_grid, window, **self.calib)
+        self.quiet = 0
+        self.redetections += 1
+
+    def _commit(self):
+        new = self.observed.copy()
+        if self.board is None:
+            self.setup = self.board = new
+            return []
+        added = (new != EMPTY) & (new != self.board)
+        blacks = [(BLACK, r, c) for r, c in zip(*np.nonzero(added & (new == BLACK)))]
+        whites = [(WHITE, r, c) for r, c in zip(*np.nonzero(added & (new == WHITE)))]
+        # Several stones at once (missed frames): alternate colours where
+        # possible, starting with whoever is due to play. After a setup of
+        # only black stones (handicap) white moves first.
+        if self.moves:
+            turn = WHITE if self.moves[-1][0] == BLACK else BLACK
+        else:
+            handicap = (self.setup == BLACK).any() and not (self.setup == WHITE).any()
+            turn = WHITE if handicap else BLACK
+        moves = []
+        while blacks or whites:
+            queue = blacks if (turn == BLACK and blacks) or not whites else whites
+            moves.append(queue.pop(0))
+            turn = WHITE if moves[-1][0] == BLACK else BLACK
+        self.moves += moves
+        self.board = new
+        return moves
+
+    def sgf(self):
+        """Setup position followed by every committed move."""
+        setup = self.setup
+        if setup is None:
+            setup = np.zeros((self.size or 19,) * 2, np.int8)
+        return BoardState(setup).to_sgf(self.moves)
+
+
+def mjpeg_frames(stream, chunk=1 << 16):
+    """Split a byte stream of back-to-back JPEGs (MJPEG) into frames."""
+    buf = bytearray()
+    while True:
+        data = stream.read(chunk)
+        if not data:
+            return
+        buf += data
+        while True:
+            start = buf.find(b'\xff\xd8')
+            end = buf.find(b'\xff\xd9', start + 2) if start != -1 else -1
+            if end == -1:
+                if start > 0:
+                    del buf[:start]
+                break
+            yield bytes(buf[start:end + 2])
+            del buf[:end + 2]
+
+
+def video_frames(source, max_side=MAX_SIDE):
+    """
+    Reduced-size grayscale frames from a video file, camera index, stream
+    URL (anything cv2.VideoCapture opens) or '-' for MJPEG on stdin.
+    """
+    if source == '-':
+        for jpg in mjpeg_frames(sys.stdin.buffer):
+            try:
+                yield decode_gray(jpg, max_side)[0]
+            except ValueError:
+                continue  # torn frame
+        return
+    cap = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not cap.isOpened():
+        raise ValueError(f"Could not open video source: {source}")
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                return
+            yield shrink(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), max_side)
+    finally:
+        cap.release()
+
+
+def track_video(source, out=None, max_side=MAX_SIDE, quiet_frames=8,
+                size=BOARD_SIZE):
+    """Run a BoardTracker over a video, rewriting `out` after every move."""
+    tracker = BoardTracker(quiet_frames=quiet_frames, size=size)
+    frames, t0 = 0, time.perf_counter()
+    for gray in video_frames(source, max_side):
+        frames += 1
+        for color, r, c in tracker.update(gray):
+            print(f'  {len(tracker.moves):>3}  {"B" if color == BLACK else "W"}'
+                  f'[{COORDS[c]}{COORDS[r]}]  (frame {frames})')
+            if out:
+                with open(out, 'w', encoding='utf-8') as f:
+                    f.write(tracker.sgf())
+    if out:
+        with open(out, 'w', encoding='utf-8') as f:
+            f.write(tracker.sgf())
+    elapsed = time.perf_counter() - t0
+    print(f'\n  {frames} frames, {frames / max(elapsed, 1e-9):.1f} fps, '
+          f'{len(tracker.moves)} moves, {tracker.redetections} board detections')
+    return tracker
 
 
 # ---------------------------------------------------------------------------
@@ -296,7 +1061,7 @@ input[type=file]{display:none}
   <p class="footer">Computer vision \u00b7 No AI credits required \u00b7 Runs on your server</p>
 </div>
 <script>
-let imageData=null,currentSGF=null;
+let imageFile=null,currentSGF=null;
 const drop=document.getElementById('dropArea');
 drop.addEventListener('dragover',e=>{e.preventDefault();drop.classList.add('over')});
 drop.addEventListener('dragleave',()=>drop.classList.remove('over'));
@@ -307,19 +1072,17 @@ drop.addEventListener('drop',e=>{
 });
 function handleFile(file){
   if(!file)return;
-  const reader=new FileReader();
-  reader.onload=e=>{
-    imageData=e.target.result;
-    document.getElementById('previewImg').src=imageData;
-    document.getElementById('step-upload').style.display='none';
-    document.getElementById('step-preview').classList.add('show');
-    document.getElementById('step-result').classList.remove('show');
-    hideError();currentSGF=null;
-  };
-  reader.readAsDataURL(file);
+  const img=document.getElementById('previewImg');
+  if(img.src)URL.revokeObjectURL(img.src);
+  imageFile=file;
+  img.src=URL.createObjectURL(file);
+  document.getElementById('step-upload').style.display='none';
+  document.getElementById('step-preview').classList.add('show');
+  document.getElementById('step-result').classList.remove('show');
+  hideError();currentSGF=null;
 }
 async function analyze(){
-  if(!imageData)return;
+  if(!imageFile)return;
   const btn=document.getElementById('btnRead');
   btn.disabled=true;btn.textContent='READING\u2026';
   document.getElementById('step-loading').classList.add('show');
@@ -328,8 +1091,8 @@ async function analyze(){
   try{
     const res=await fetch('/analyze',{
       method:'POST',
-      headers:{'Content-Type':'application/json'},
-      body:JSON.stringify({image_b64:imageData.split(',')[1],media_type:imageData.match(/data:(.*?);/)[1]})
+      headers:{'Content-Type':imageFile.type||'application/octet-stream'},
+      body:imageFile
     });
     const data=await res.json();
     if(!res.ok||data.error)throw new Error(data.error||`Server error (${res.status})`);
@@ -337,7 +1100,9 @@ async function analyze(){
     document.getElementById('sgfBox').textContent=data.sgf;
     document.getElementById('counts').innerHTML=`
       <div class="count-item"><div class="dot b"></div>${data.black} black stone${data.black!==1?'s':''}</div>
-      <div class="count-item"><div class="dot w"></div>${data.white} white stone${data.white!==1?'s':''}</div>`;
+      <div class="count-item"><div class="dot w"></div>${data.white} white stone${data.white!==1?'s':''}</div>`+
+      ((data.uncertain||[]).length?`
+      <div class="count-item">${data.uncertain.length} unsure: ${data.uncertain.join(' ')}</div>`:'');
     document.getElementById('step-result').classList.add('show');
   }catch(err){
     showError('Could not read board',err.message);
@@ -361,7 +1126,7 @@ function showError(title,detail){
 }
 function hideError(){document.getElementById('step-error').classList.remove('show')}
 function resetToUpload(){
-  imageData=null;currentSGF=null;
+  imageFile=null;currentSGF=null;
   document.getElementById('fileInput').value='';
   document.getElementById('step-preview').classList.remove('show');
   document.getElementById('step-result').classList.remove('show');
@@ -373,51 +1138,1146 @@ function resetAll(){resetToUpload()}
 </body>
 </html>"""
 HTML = HTML_STR.encode("utf-8")
+HTML_GZ = gzip.compress(HTML, 9)
+HTML_ETAG = '"%s"' % hashlib.blake2b(HTML, digest_size=8).hexdigest()
+
+# ---------------------------------------------------------------------------
+# Worker pool
+# ---------------------------------------------------------------------------
+
+class ServerBusy(Exception):
+    pass
+
+
+def tune_cv():
+    cv2.setNumThreads(CV_THREADS)
+    cv2.setUseOptimized(CV_OPTIMIZED)
+
+
+def warm_up():
+    """
+    Run the whole pipeline once on a small synthetic board so the first
+    real request doesn't pay for OpenCV's lazy initialisation (codecs,
+    dispatch tables, thread pool) or first-touch allocations.
+    """
+    tune_cv()
+    img, _ = render_board(width=640, seed=0)
+    image_to_sgf(cv2.imencode('.jpg', img)[1].tobytes())
+
+
+_WARM_UP_ERROR = None
+
+
+def _init_worker():
+    global _WARM_UP_ERROR
+    # The parent drains the pool on shutdown; a group-wide SIGTERM must not
+    # run the inherited server handler (or kill jobs) in the workers.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    try:
+        warm_up()
+    except Exception as e:
+        # Raising here would break the whole pool; keep the worker, log the
+        # failure and report it to WorkerPool.warm_up
+        _WARM_UP_ERROR = e
+        log_json(event='warm_up', pid=os.getpid(), error=error_message(e))
+
+
+def _warm_up_result():
+    if _WARM_UP_ERROR is not None:
+        raise _WARM_UP_ERROR
+    return os.getpid()
+
+
+def analyze_image(img_bytes, size=BOARD_SIZE):
+    """Worker entry point: read_board plus its per-stage timings (ms)."""
+    timings = {}
+    return read_board(img_bytes, timings=timings, size=size), timings
+
+
+def _kill_executor(executor):
+    # Workers ignore SIGTERM (see _init_worker), so the terminate() a broken
+    # executor sends its surviving workers never lands: SIGKILL them instead
+    executor.shutdown(wait=False, cancel_futures=True)
+    for p in list((getattr(executor, '_processes', None) or {}).values()):
+        p.kill()
+
+
+class WorkerPool:
+    """
+    Runs pipeline calls in a pool of worker processes.
+    At most workers + queue_depth calls are admitted at once; anything
+    beyond that raises ServerBusy immediately instead of waiting.
+    If a worker dies (OOM kill, decoder crash) the calls it broke fail and
+    the executor is replaced, calling on_restart once the new one exists.
+    """
+
+    def __init__(self, workers=WORKERS, queue_depth=QUEUE_DEPTH, on_restart=None):
+        self.workers = max(workers, 1)
+        self.processes = workers
+        self.executor = self._executor()
+        self.slots = threading.BoundedSemaphore(self.workers + queue_depth)
+        self.lock = threading.Lock()
+        self.on_restart = on_restart
+        self.restarts = 0
+
+    def _executor(self):
+        if self.processes <= 0:
+            return None
+        return ProcessPoolExecutor(self.processes, initializer=_init_worker)
+
+    def _replace(self, broken):
+        """Swap out a broken executor (once, however many calls saw it)."""
+        with self.lock:
+            if self.executor is not broken:
+                return
+            self.executor = self._executor()
+            self.restarts += 1
+        _kill_executor(broken)
+        log_json(event='pool_restart', restarts=self.restarts)
+        if self.on_restart is not None:
+            self.on_restart()
+
+    def _submit(self, fn, *args):
+        """executor.submit plus the executor it went to."""
+        executor = self.executor
+        try:
+            return executor, executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._replace(executor)
+            raise
+
+    @contextmanager
+    def admit(self):
+        if not self.slots.acquire(blocking=False):
+            raise ServerBusy("Server is busy. Please try again shortly.")
+        try:
+            yield
+        finally:
+            self.slots.release()
+
+    def run(self, fn, *args):
+        with self.admit():
+            if self.executor is None:
+                return fn(*args)
+            executor, future = self._submit(fn, *args)
+            try:
+                return future.result()
+            except BrokenProcessPool:
+                self._replace(executor)
+                raise
+
+    def imap(self, fn, jobs):
+        """
+        Run fn(*args) for each (key, args) in jobs, yielding (key, result)
+        in completion order; result is the exception if that call failed.
+        Jobs are pulled lazily with at most `workers` outstanding, and each
+        waits for an admission slot, so batches count against the same
+        workers + queue_depth bound as run().
+        """
+        if self.executor is None:
+            for key, args in jobs:
+                self.slots.acquire()
+                try:
+                    yield key, fn(*args)
+                except Exception as e:
+                    yield key, e
+                finally:
+                    self.slots.release()
+            return
+        pending = {}
+
+        def drain(return_when):
+            done, _ = wait(pending, return_when=return_when)
+            for f in done:
+                key, executor = pending.pop(f)
+                e = f.exception()
+                if isinstance(e, BrokenProcessPool):
+                    self._replace(executor)
+                yield key, e if e is not None else f.result()
+
+        for key, args in jobs:
+            self.slots.acquire()
+            try:
+                executor, future = self._submit(fn, *args)
+            except BrokenProcessPool as e:
+                self.slots.release()
+                yield key, e
+                continue
+            except BaseException:
+                self.slots.release()
+                raise
+            future.add_done_callback(lambda _: self.slots.release())
+            pending[future] = key, executor
+            if len(pending) >= self.workers:
+                yield from drain(FIRST_COMPLETED)
+        while pending:
+            yield from drain(FIRST_COMPLETED)
+
+    def warm_up(self):
+        """
+        Start (and so warm up) every worker process now, not on first use;
+        raises if a worker's warm-up failed.
+        """
+        if self.executor is None:
+            return warm_up()
+        for executor, f in [self._submit(_warm_up_result)
+                            for _ in range(self.workers)]:
+            try:
+                f.result()
+            except BrokenProcessPool:
+                self._replace(executor)
+                raise
+
+    def healthy(self):
+        """
+        False if a worker has died since the pool was last used (the
+        executor is replaced then). A no-op submit is the only public way
+        to find out: a broken executor refuses it straight away.
+        """
+        if self.executor is None:
+            return True
+        try:
+            self._submit(int)
+        except BrokenProcessPool:
+            return False
+        return True
+
+    def shutdown(self):
+        # A pool that broke while idle would never finish shutting down
+        if self.executor is not None and self.healthy():
+            self.executor.shutdown(wait=True)
+
+
+# ---------------------------------------------------------------------------
+# Result cache
+# ---------------------------------------------------------------------------
+
+# Any edit to this file changes the pipeline, so it invalidates old entries
+with open(__file__, 'rb') as _f:
+    PIPELINE_ID = hashlib.blake2b(_f.read(), digest_size=8).hexdigest()
+
+
+class ResultCache:
+    """
+    LRU of image_to_sgf results keyed by a hash of the uploaded image bytes
+    and the pipeline parameters. Entries expire after `ttl` seconds. With a
+    directory, results are also written there as JSON and reloaded on a
+    memory miss, so they survive restarts. The directory is swept of
+    expired files, and trimmed when over disk_entries, at startup and then
+    every SWEEP_EVERY writes or whenever it may be over the cap.
+    """
+
+    SWEEP_EVERY = 64
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL, directory=CACHE_DIR,
+                 disk_entries=CACHE_DISK_ENTRIES):
+        self.size, self.ttl, self.directory = size, ttl, directory
+        self.disk_entries = disk_entries
+        self.entries = OrderedDict()  # key -> (expires_at, result)
+        self.lock = threading.Lock()
+        self.sweeping = threading.Lock()
+        self.hits = self.misses = 0
+        self.files = self.writes = 0  # files on disk (at most), since last sweep
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._sweep()
+
+    @staticmethod
+    def key(img_bytes, **params):
+        h = hashlib.blake2b(img_bytes, digest_size=20)
+        h.update(json.dumps([PIPELINE_ID, params], sort_keys=True).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.entries.pop(key, None)
+        loaded = self._load(key, now)
+        with self.lock:
+            if loaded is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, *loaded)
+            return loaded[1]
+
+    def put(self, key, result):
+        if self.size <= 0:
+            return
+        expires = time.time() + self.ttl
+        with self.lock:
+            self._remember(key, expires, result)
+        if self.directory:
+            path = self._path(key)
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(result, f)
+                os.replace(tmp, path)
+            except OSError as e:
+                # Best effort: the result is still cached in memory
+                log_json(event='cache_write', error=error_message(e))
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                return
+            with self.lock:
+                self.files += 1
+                self.writes += 1
+                due = (self.writes >= self.SWEEP_EVERY
+                       or self.files > self.disk_entries)
+            if due and self.sweeping.acquire(blocking=False):
+                try:
+                    self._sweep()
+                finally:
+                    self.sweeping.release()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries), 'size': self.size,
+                    'ttl': self.ttl, 'disk': bool(self.directory)}
+
+    def _remember(self, key, expires, result):
+        if self.size <= 0:
+            return
+        self.entries[key] = (expires, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def _load(self, key, now):
+        """(expires_at, result) from disk, or None if absent or expired."""
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            expires = os.path.getmtime(path) + self.ttl
+            if expires <= now:
+                os.remove(path)
+                return None
+            with open(path, encoding='utf-8') as f:
+                return expires, json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _sweep(self):
+        """Delete expired files, then the oldest down to 90% of disk_entries
+        so a full directory isn't swept again on every write."""
+        now = time.time()
+        kept = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError as e:
+            log_json(event='cache_sweep', error=error_message(e))
+            return
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.path.getmtime(path)
+                if mtime + self.ttl <= now:
+                    os.remove(path)
+                else:
+                    kept.append((mtime, path))
+            except OSError:
+                pass
+        kept.sort()
+        if len(kept) > self.disk_entries:
+            del_n = len(kept) - self.disk_entries * 9 // 10
+        else:
+            del_n = 0
+        for _, path in kept[:del_n]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self.lock:
+            self.files = len(kept) - del_n
+            self.writes = 0
+
+
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+
+class Metrics:
+    """Request counters and per-stage latency histograms, Prometheus style."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    PATHS = ('/', '/analyze', '/batch', '/stats', '/metrics', '/healthz', '/readyz')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # (path, status) -> count
+        self.errors = {}    # kind -> count
+        self.stages = {}    # stage -> [bucket counts..., sum, count]
+        self.active = 0
+
+    @contextmanager
+    def in_flight(self):
+        with self.lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def request(self, path, status):
+        path = path if path in self.PATHS else 'other'
+        with self.lock:
+            self.requests[path, status] = self.requests.get((path, status), 0) + 1
+
+    def error(self, kind):
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def observe(self, timings):
+        """Record a {stage: milliseconds} dict."""
+        with self.lock:
+            for stage, ms in timings.items():
+                h = self.stages.setdefault(stage, [0] * (len(self.BUCKETS) + 2))
+                seconds = ms / 1000
+                for i, le in enumerate(self.BUCKETS):
+                    if seconds <= le:
+                        h[i] += 1
+                h[-2] += seconds
+                h[-1] += 1
+
+    def render(self, cache=None):
+        with self.lock:
+            out = ['# HELP stone_requests_total HTTP requests by path and status.',
+                   '# TYPE stone_requests_total counter']
+            for (path, status), n in sorted(self.requests.items()):
+                out.append(f'stone_requests_total{{path="{path}",status="{status}"}} {n}')
+            out += ['# HELP stone_errors_total Failed analyses by kind.',
+                    '# TYPE stone_errors_total counter']
+            for kind, n in sorted(self.errors.items()):
+                out.append(f'stone_errors_total{{kind="{kind}"}} {n}')
+            out += ['# HELP stone_in_flight_requests POST requests being handled.',
+                    '# TYPE stone_in_flight_requests gauge',
+                    f'stone_in_flight_requests {self.active}',
+                    '# HELP stone_stage_seconds Time spent in each analysis stage.',
+                    '# TYPE stone_stage_seconds histogram']
+            for stage, h in sorted(self.stages.items()):
+                for le, n in zip(self.BUCKETS, h):
+                    out.append(f'stone_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {n}')
+                out.append(f'stone_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {h[-1]}')
+                out.append(f'stone_stage_seconds_sum{{stage="{stage}"}} {h[-2]:.6f}')
+                out.append(f'stone_stage_seconds_count{{stage="{stage}"}} {h[-1]}')
+        if cache is not None:
+            stats = cache.stats()
+            out += ['# HELP stone_cache_hits_total Result cache hits.',
+                    '# TYPE stone_cache_hits_total counter',
+                    f'stone_cache_hits_total {stats["hits"]}',
+                    '# HELP stone_cache_misses_total Result cache misses.',
+                    '# TYPE stone_cache_misses_total counter',
+                    f'stone_cache_misses_total {stats["misses"]}',
+                    '# HELP stone_cache_entries Results held in memory.',
+                    '# TYPE stone_cache_entries gauge',
+                    f'stone_cache_entries {stats["entries"]}']
+        return '\n'.join(out) + '\n'
+
+
+def log_json(**fields):
+    print(json.dumps({'ts': round(time.time(), 3), **fields}), flush=True)
+
+
+POOL = None
+CACHE = None
+METRICS = Metrics()
+READY = threading.Event()  # set once warmed up, cleared while draining
+DRAINING = threading.Event()
 
 # ---------------------------------------------------------------------------
 # HTTP Server
 # ---------------------------------------------------------------------------
 
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.webp')
+READ_CHUNK = 1 << 16
+# How much of a refused body is read (and dropped) after the reply, so the
+# client has stopped sending and can read it before the connection closes
+DISCARD_BYTES = 1 << 20
+DISCARD_TIMEOUT = 1.0
+
+
+class Backpressure(Exception):
+    pass
+
+
+class BodyBudget:
+    """
+    Bytes of request bodies buffered at once, across all requests. A body
+    that doesn't fit is refused without being buffered, so a burst of
+    large uploads waits its turn at the client instead of in our memory.
+    A lone body is always let through.
+    """
+
+    def __init__(self, limit_bytes):
+        self.limit = limit_bytes
+        self.held = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, n):
+        with self.lock:
+            if self.held and self.held + n > self.limit:
+                raise Backpressure
+            self.held += n
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.held -= n
+
+
+BODIES = BodyBudget(MAX_BUFFERED_MB * 2**20)
+
+
+def multipart_files(buf, boundary):
+    """Yield (filename, start, end) for each file part of a multipart body."""
+    delim = b'--' + boundary.encode('latin-1')
+    start = buf.find(delim)
+    while start != -1:
+        head_start = start + len(delim) + 2
+        head_end = buf.find(b'\r\n\r\n', head_start)
+        if head_end == -1:
+            return
+        end = buf.find(b'\r\n' + delim, head_end + 4)
+        if end == -1:
+            return
+        headers = bytes(buf[head_start:head_end]).decode('utf-8', 'replace')
+        name = None
+        for param in headers.replace('\r\n', ';').split(';'):
+            key, _, value = param.strip().partition('=')
+            if key.lower() == 'filename':
+                name = value.strip('"')
+            elif key.lower() == 'name' and value.strip('"') == 'image':
+                name = name or 'image'
+        if name is not None:
+            yield name, head_end + 4, end
+        start = end + 2
+
+
+def multipart_image(buf, boundary):
+    """
+    Trim a multipart/form-data body in place down to its first file part
+    (or the part named "image"). Deleting from the front of a bytearray
+    only moves its start pointer, so the image bytes are not copied.
+    """
+    for _, start, end in multipart_files(buf, boundary):
+        del buf[end:]
+        del buf[:start]
+        return buf
+    raise ValueError("No image file found in the upload.")
+
+
+def zip_images(buf, max_bytes=MAX_UPLOAD_MB * 2**20):
+    """
+    Generator of (name, bytes) for each image in a zip, read lazily. An
+    entry over max_bytes uncompressed (by its header, which zipfile also
+    holds the decompressor to) comes back as (name, TooLarge) unread.
+    """
+    try:
+        zf = zipfile.ZipFile(io.BytesIO(buf))
+    except zipfile.BadZipFile:
+        raise ValueError("Upload is not a valid zip archive.")
+    infos = [i for i in zf.infolist()
+             if not i.is_dir() and not i.filename.startswith('__MACOSX/')
+             and i.filename.lower().endswith(IMAGE_EXTS)]
+    if not infos:
+        raise ValueError("No images found in the zip archive.")
+
+    def read():
+        with zf:
+            for info in infos:
+                if info.file_size > max_bytes:
+                    yield info.filename, TooLarge(
+                        f"File is {info.file_size / 2**20:.1f} MB uncompressed; "
+                        f"the limit is {max_bytes / 2**20:g} MB.")
+                    continue
+                try:
+                    data = zf.read(info)
+                except Exception:
+                    data = b''  # reported per file as undecodable
+                yield info.filename, data
+    return read()
+
+
+# ?format= for /analyze: BoardState serializer and Content-Type
+RESPONSE_FORMATS = {
+    'json': (None, 'application/json'),
+    'sgf': ('to_sgf', 'application/x-go-sgf; charset=utf-8'),
+    'binary': ('to_bytes', 'application/octet-stream'),
+    'diagram': ('to_diagram', 'text/plain; charset=utf-8'),
+}
+
+
+def error_message(e):
+    if isinstance(e, ValueError):
+        return str(e)
+    return f'Server error: {str(e)}'
+
+
 class Handler(http.server.BaseHTTPRequestHandler):
+    timeout = READ_TIMEOUT  # per socket read, headers included
 
     def log_message(self, fmt, *args):
-        print(f"  {self.command} {self.path}")
+        # Access and error lines share stdout with log_json, so keep them JSON.
+        log_json(event='http', method=getattr(self, 'command', None),
+                 path=getattr(self, 'path', None), message=fmt % args)
+
+    def send_response(self, code, message=None):
+        self.status = code
+        # send_error can run before the request line is parsed (400, 414)
+        METRICS.request(getattr(self, 'path', '').partition('?')[0], code)
+        super().send_response(code, message)
 
     def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(HTML)
+        if self.path == '/healthz':
+            return self._respond(200, {'status': 'ok'})
+        if self.path == '/readyz':
+            if READY.is_set() and POOL.healthy():
+                return self._respond(200, {'status': 'ready'})
+            return self._respond(503, {'status': 'starting'}, {'Retry-After': '1'})
+        if self.path == '/stats':
+            return self._respond(200, {'cache': CACHE.stats()})
+        if self.path == '/metrics':
+            body = METRICS.render(CACHE).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self._html()
+
+    def _html(self):
+        """The page, compressed once at import: gzip when accepted, 304 on ETag."""
+        headers = {'ETag': HTML_ETAG, 'Cache-Control': 'public, max-age=300',
+                   'Vary': 'Accept-Encoding'}
+        if HTML_ETAG in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            return
+        body = HTML
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body, headers['Content-Encoding'] = HTML_GZ, 'gzip'
+        self._send(200, body, 'text/html; charset=utf-8', headers)
+
+    def _refuse(self, length, limit):
+        """
+        413 for a body over the limit, else 429: no room to buffer it now.
+        Sent straight away without reading the body; the connection is
+        closed after a short, bounded drain.
+        """
+        self.close_connection = True
+        if length > limit:
+            METRICS.error('too_large')
+            self._respond(413, {'error': f"Upload is {length / 2**20:.1f} MB; "
+                                         f"the limit is {limit / 2**20:g} MB."},
+                          {'Connection': 'close'})
+        else:
+            METRICS.error('backpressure')
+            self._respond(429, {'error': "Too many uploads in progress. "
+                                         "Please try again shortly."},
+                          {'Retry-After': '2', 'Connection': 'close'})
+        self._discard_body(min(length, DISCARD_BYTES))
 
     def do_POST(self):
-        if self.path != '/analyze':
-            self.send_response(404); self.end_headers(); return
-        length = int(self.headers.get('Content-Length', 0))
+        path, _, query = self.path.partition('?')
+        with METRICS.in_flight():
+            if path not in ('/analyze', '/batch'):
+                self.send_response(404); self.end_headers(); return
+            # Don't trust Content-Length: validate it, then refuse oversized
+            # or unaffordable bodies before buffering them
+            length = self.headers.get('Content-Length')
+            if length is None or not (length.isascii() and length.isdigit()):
+                METRICS.error('invalid')
+                self.close_connection = True  # can't tell where the body ends
+                if length is None:
+                    return self._respond(411, {'error': "Content-Length is required."})
+                return self._respond(400, {'error': "Invalid Content-Length."})
+            length = int(length)
+            limit = (MAX_BATCH_MB if path == '/batch' else MAX_UPLOAD_MB) * 2**20
+            if length > limit:
+                return self._refuse(length, limit)
+            try:
+                with BODIES.hold(length):
+                    params = dict(p.partition('=')[::2] for p in query.split('&') if p)
+                    size = params.get('size', str(BOARD_SIZE or 'auto'))
+                    if path == '/batch':
+                        return self._batch(size)
+                    self._analyze(params.get('format', 'json'),
+                                  params.get('timings') == '1', size)
+            except Backpressure:
+                self._refuse(length, limit)
+
+    def _analyze(self, fmt='json', want_timings=False, size='auto'):
+        """
+        One image -> board. The reply is JSON (SGF text, counts and the
+        board) unless fmt asks for raw 'sgf', packed 'binary' or a text
+        'diagram'; size is 'auto' or the number of lines per side. Stage
+        times (ms) go to /metrics and a JSON log line, and into the JSON
+        reply as timings_ms when asked for.
+        """
+        t0 = time.perf_counter()
+        timings, cached, self.status = {}, None, None
         try:
-            body = json.loads(self.rfile.read(length))
-            img_bytes = base64.b64decode(body.get('image_b64', ''))
-            sgf, black, white = image_to_sgf(img_bytes)
-            self._respond(200, {'sgf': sgf, 'black': black, 'white': white})
+            if fmt not in RESPONSE_FORMATS:
+                raise ValueError(f"Unknown format: {fmt}")
+            size = parse_board_size(size)
+            img_bytes = self._read_image(timings)
+            check_image_size(img_bytes)
+            key = CACHE.key(img_bytes, max_side=MAX_SIDE, rectify=RECTIFY_SIZE,
+                            size=size)
+            saved = CACHE.get(key)
+            cached = saved is not None
+            if cached:
+                state = BoardState.from_json(saved)
+            else:
+                t = time.perf_counter()
+                state, stages = POOL.run(analyze_image, img_bytes, size)
+                wall = (time.perf_counter() - t) * 1000
+                timings.update(stages)
+                # Waiting for a worker plus shipping the image across
+                timings['queue'] = max(0.0, wall - sum(stages.values()))
+                CACHE.put(key, state.to_json())
+            with timed(timings, 'serialize'):
+                if fmt == 'json':
+                    body = {'sgf': state.to_sgf(), **state.to_json(), 'cached': cached}
+                else:
+                    body = getattr(state, RESPONSE_FORMATS[fmt][0])()
+                    if isinstance(body, str):
+                        body = body.encode('utf-8')
+            timings['total'] = (time.perf_counter() - t0) * 1000
+            if fmt == 'json':
+                if want_timings:
+                    body['timings_ms'] = {k: round(v, 3) for k, v in timings.items()}
+                self._respond(200, body)
+            else:
+                self._send(200, body, RESPONSE_FORMATS[fmt][1],
+                           {'X-Cached': str(cached).lower()})
+        except ServerBusy as e:
+            METRICS.error('busy')
+            self._respond(503, {'error': str(e)}, {'Retry-After': '2'})
+        except TooLarge as e:
+            METRICS.error('too_large')
+            self._respond(413, {'error': str(e)})
+        except TimeoutError:
+            METRICS.error('timeout')
+            self.close_connection = True
+            self._respond(408, {'error': "Upload timed out. Please try again."})
         except ValueError as e:
+            METRICS.error('invalid')
             self._respond(400, {'error': str(e)})
         except Exception as e:
+            METRICS.error('internal')
             traceback.print_exc()
-            self._respond(500, {'error': f'Server error: {str(e)}'})
+            self._respond(500, {'error': error_message(e)})
+        finally:
+            timings.setdefault('total', (time.perf_counter() - t0) * 1000)
+            METRICS.observe(timings)
+            log_json(event='analyze', status=self.status, cached=cached,
+                     ms={k: round(v, 3) for k, v in timings.items()})
+
+    def _batch(self, size='auto'):
+        """
+        Analyze every image in a multipart upload or zip body, streaming
+        back one NDJSON line per image as each finishes; size as in _analyze.
+        """
+        try:
+            size = parse_board_size(size)
+            # Refuse up front if the pool is already full; after that each
+            # image waits for a slot of its own inside POOL.imap
+            with POOL.admit():
+                pass
+            # Check the body's type before buffering up to MAX_BATCH_MB of it
+            ctype = self.headers.get_content_type()
+            boundary = self.headers.get_param('boundary')
+            if ctype == 'multipart/form-data':
+                if not boundary:
+                    raise ValueError("Multipart upload is missing its boundary.")
+            elif ctype not in ('application/zip', 'application/x-zip-compressed'):
+                raise ValueError(f"Unsupported Content-Type: {ctype}")
+            buf = self._read_body()
+            if ctype == 'multipart/form-data':
+                parts = list(multipart_files(buf, boundary))
+                if not parts:
+                    raise ValueError("No image files found in the upload.")
+                files = ((name, bytes(buf[a:b])) for name, a, b in parts)
+            else:
+                files = zip_images(buf)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+
+            def emit(name, result):
+                if isinstance(result, Exception):
+                    result = {'error': error_message(result)}
+                line = json.dumps({'name': name, **result}) + '\n'
+                self.wfile.write(line.encode('utf-8'))
+
+            def jobs():
+                for name, img in files:
+                    if isinstance(img, Exception):
+                        emit(name, img)  # refused before reaching the pool
+                    else:
+                        yield name, (img, MAX_SIDE, None, RECTIFY_SIZE, size)
+
+            for name, result in POOL.imap(image_to_sgf, jobs()):
+                emit(name, result)
+        except ServerBusy as e:
+            METRICS.error('busy')
+            self._respond(503, {'error': str(e)}, {'Retry-After': '2'})
+        except TimeoutError:
+            METRICS.error('timeout')
+            self.close_connection = True
+            self._respond(408, {'error': "Upload timed out. Please try again."})
+        except ValueError as e:
+            METRICS.error('invalid')
+            self._respond(400, {'error': str(e)})
+
+    def _read_body(self):
+        """
+        Read the request body into one preallocated bytearray, READ_CHUNK
+        bytes at a time: each read times out after READ_TIMEOUT s (the
+        socket timeout) and the whole body after UPLOAD_TIMEOUT s.
+        """
+        length = int(self.headers.get('Content-Length') or 0)
+        deadline = time.monotonic() + UPLOAD_TIMEOUT
+        buf = bytearray(length)
+        n = 0
+        with memoryview(buf) as view:
+            while n < length:
+                got = self.rfile.readinto1(view[n:n + READ_CHUNK])
+                if not got:
+                    break
+                n += got
+                if time.monotonic() > deadline:
+                    raise TimeoutError
+        if n < length:
+            raise ValueError("Upload was cut off. Please try again.")
+        return buf
 
-    def _respond(self, status, data):
-        body = json.dumps(data).encode('utf-8')
+    def _discard_body(self, length):
+        scratch = bytearray(READ_CHUNK)
+        deadline = time.monotonic() + DISCARD_TIMEOUT
+        try:
+            self.connection.settimeout(DISCARD_TIMEOUT)
+            while length > 0 and time.monotonic() < deadline:
+                got = self.rfile.readinto1(memoryview(scratch)[:min(length, READ_CHUNK)])
+                if not got:
+                    break
+                length -= got
+        except OSError:
+            pass
+        if length > 0:
+            self.close_connection = True
+
+    def _read_image(self, timings=None):
+        """
+        Image bytes from a raw image/* body, a multipart/form-data upload,
+        or the legacy JSON {"image_b64": ...} body. Any other Content-Type
+        (or none, e.g. curl -d's form-urlencoded) is read as legacy JSON,
+        as it always was.
+        """
+        ctype = self.headers.get_content_type()
+        if ctype.startswith('image/') or ctype == 'application/octet-stream':
+            with timed(timings, 'read'):
+                return self._read_body()
+        if ctype == 'multipart/form-data':
+            boundary = self.headers.get_param('boundary')
+            if not boundary:
+                raise ValueError("Multipart upload is missing its boundary.")
+            with timed(timings, 'read'):
+                return multipart_image(self._read_body(), boundary)
+        with timed(timings, 'read'):
+            body = json.loads(self._read_body())
+        with timed(timings, 'base64'):
+            return base64.b64decode(body.get('image_b64', ''))
+
+    def _respond(self, status, data, headers=None):
+        self._send(status, json.dumps(data).encode('utf-8'),
+                   'application/json', headers)
+
+    def _send(self, status, body, ctype, headers=None):
         self.send_response(status)
-        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Type', ctype)
         self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
         self.end_headers()
         self.wfile.write(body)
 
 
-if __name__ == '__main__':
-    server = http.server.HTTPServer(('0.0.0.0', PORT), Handler)
-    print(f'\n  Stone to SGF  \u2014  port {PORT}\n')
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = False  # server_close() waits for in-flight requests
+
+
+def _warm_up():
+    t0 = time.perf_counter()
+    try:
+        POOL.warm_up()
+    except Exception as e:
+        log_json(event='warm_up', error=error_message(e))
+        return  # /readyz stays 503
+    if not DRAINING.is_set():
+        READY.set()
+    log_json(event='ready', warm_up_ms=round((time.perf_counter() - t0) * 1000, 1))
+
+
+def _restarted():
+    # A worker died and the pool was replaced: not ready until it warms up
+    READY.clear()
+    if not DRAINING.is_set():
+        threading.Thread(target=_warm_up, daemon=True).start()
+
+
+def _drain(server):
+    DRAINING.set()
+    READY.clear()
+    server.shutdown()
+
+
+def serve():
+    global POOL, CACHE
+    tune_cv()
+    POOL = WorkerPool(on_restart=_restarted)
+    CACHE = ResultCache()
+    server = Server(('0.0.0.0', PORT), Handler)
+    # Listen straight away (/healthz answers); /readyz waits for warm-up
+    threading.Thread(target=_warm_up, daemon=True).start()
+    # SIGTERM (Render redeploys) stops accepting, then drains like Ctrl-C
+    signal.signal(signal.SIGTERM,
+                  lambda *_: threading.Thread(target=_drain, args=(server,)).start())
+    print(f'\n  Stone to SGF  \u2014  port {PORT}  '
+          f'\u2014  {WORKERS} workers, queue {QUEUE_DEPTH}\n', file=sys.stderr)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
-        print('\n  Stopped.')
-        server.shutdown()
+        pass
+    print('\n  Stopped.', file=sys.stderr)
+    DRAINING.set()
+    READY.clear()
+    server.server_close()
+    POOL.shutdown()
+
+
+# ---------------------------------------------------------------------------
+# Offline batch conversion
+# ---------------------------------------------------------------------------
+
+def convert_file(src, dst, size=BOARD_SIZE):
+    with open(src, 'rb') as f:
+        result = image_to_sgf(f.read(), size=size)
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    with open(dst, 'w', encoding='utf-8') as f:
+        f.write(result['sgf'])
+    return result
+
+
+def convert_dir(src_dir, out_dir=None, workers=WORKERS, size=BOARD_SIZE):
+    """
+    Convert every image under src_dir to a .sgf, mirroring the tree;
+    size is the number of lines per side, 0 to infer it per image.
+    """
+    jobs = []
+    for root, dirs, files in os.walk(src_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTS):
+                rel = os.path.relpath(os.path.join(root, name), src_dir)
+                dst = os.path.join(out_dir or src_dir,
+                                   os.path.splitext(rel)[0] + '.sgf')
+                jobs.append((rel, (os.path.join(root, name), dst, size)))
+    pool = WorkerPool(workers, 0)
+    failed = 0
+    try:
+        for rel, result in pool.imap(convert_file, jobs):
+            if isinstance(result, Exception):
+                failed += 1
+                print(f'  FAIL  {rel}: {error_message(result)}')
+            else:
+                print(f'  ok    {rel}  ({result["black"]} black, '
+                      f'{result["white"]} white)')
+    finally:
+        pool.shutdown()
+    print(f'\n  {len(jobs) - failed}/{len(jobs)} converted')
+    return failed
+
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------------------------
+
+BENCH_STAGES = ('decode', 'board', 'grid', 'classify', 'sgf')
+
+# Each case is passed to render_board; 'format' picks the upload encoding.
+BENCH_CASES = [
+    {'name': 'screenshot-800', 'width': 800, 'format': '.png'},
+    {'name': 'photo-2000', 'width': 2000, 'noise': 4, 'lighting': 0.2},
+    {'name': 'phone-4000x3000', 'width': 4000, 'height': 3000,
+     'noise': 6, 'lighting': 0.3},
+    {'name': 'rotated-2deg', 'width': 2000, 'rotation': 2, 'noise': 4},
+    {'name': 'perspective-3pct', 'width': 2000, 'perspective': 0.03, 'noise': 4},
+    {'name': 'dim-noisy', 'width': 1600, 'noise': 12, 'lighting': 0.5},
+    {'name': '13x13-1200', 'size': 13, 'width': 1200, 'noise': 4},
+    {'name': '9x9-1200', 'size': 9, 'width': 1200, 'noise': 4},
+]
+
+
+def _bench_read(img_bytes, max_side, timings):
+    """One timed read + SGF; None if the board couldn't be read."""
+    try:
+        state = read_board(img_bytes, max_side, timings)
+        with timed(timings, 'sgf'):
+            state.to_sgf()
+        return state.stones
+    except ValueError:
+        return None
+
+
+def bench_case(case, repeats=3, seed=0, max_side=MAX_SIDE):
+    case = dict(case)
+    name, fmt = case.pop('name'), case.pop('format', '.jpg')
+    stage_ms = {stage: [] for stage in BENCH_STAGES}
+    total_ms, peaks, correct, exact, errors, cells = [], [], 0, 0, 0, 0
+    for i in range(repeats):
+        img, truth = render_board(seed=seed + i, **case)
+        ok, enc = cv2.imencode(fmt, img)
+        img_bytes = enc.tobytes()
+        del img, enc
+        # Timed without tracemalloc (it inflates times by ~20%), then a
+        # second, traced run for peak memory only.
+        timings = {}
+        t0 = time.perf_counter()
+        labels = _bench_read(img_bytes, max_side, timings)
+        total_ms.append((time.perf_counter() - t0) * 1000)
+        tracemalloc.start()
+        _bench_read(img_bytes, max_side, {})
+        peaks.append(tracemalloc.get_traced_memory()[1] / 2**20)
+        tracemalloc.stop()
+        if labels is None:
+            errors += 1
+            labels = np.zeros_like(truth)
+        for stage in BENCH_STAGES:
+            stage_ms[stage].append(timings.get(stage, 0.0))
+        if labels.shape == truth.shape:
+            correct += int((labels == truth).sum())
+            exact += bool((labels == truth).all())
+        cells += truth.size
+    return name, {
+        'stages_ms': {k: round(float(np.median(v)), 3) for k, v in stage_ms.items()},
+        'total_ms': round(float(np.median(total_ms)), 3),
+        'peak_mb': round(max(peaks), 2),
+        'accuracy': round(correct / cells, 4),
+        'exact': exact / repeats,
+        'errors': errors,
+        'repeats': repeats,
+    }
+
+
+def run_bench(cases=BENCH_CASES, repeats=3, seed=0, max_side=MAX_SIDE):
+    """
+    Time each pipeline stage, record peak Python/NumPy-visible memory
+    (tracemalloc) and score labels against the rendered ground truth.
+    """
+    import platform
+    cv2.setNumThreads(1)
+    results = {
+        'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 'python': platform.python_version(),
+                 'opencv': cv2.__version__, 'numpy': np.__version__,
+                 'machine': platform.machine(), 'pipeline': PIPELINE_ID,
+                 'max_side': max_side, 'repeats': repeats, 'seed': seed},
+        'cases': {},
+    }
+    for case in cases:
+        name, r = bench_case(case, repeats, seed, max_side)
+        results['cases'][name] = r
+        print(f'  {name:<20} {r["total_ms"]:>9.1f} ms  {r["peak_mb"]:>7.1f} MB  '
+              f'acc {r["accuracy"]:.3f}  exact {r["exact"]:.2f}  '
+              + ' '.join(f'{k}={v:.1f}' for k, v in r['stages_ms'].items()))
+    return results
+
+
+def compare_bench(base, new, tolerance=0.15):
+    """Print changes against a saved run; return the number of regressions."""
+    regressions = 0
+    for name, r in new['cases'].items():
+        b = base['cases'].get(name)
+        if b is None:
+            continue
+        slower = r['total_ms'] > b['total_ms'] * (1 + tolerance)
+        worse = r['accuracy'] < b['accuracy'] - 0.005
+        flag = '  REGRESSION' if slower or worse else ''
+        regressions += bool(flag)
+        print(f'  {name:<20} {b["total_ms"]:>9.1f} -> {r["total_ms"]:>9.1f} ms  '
+              f'acc {b["accuracy"]:.3f} -> {r["accuracy"]:.3f}{flag}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Go board photo to SGF.')
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('serve', help='run the web server (default)')
+    p = sub.add_parser('convert', help='convert a directory of board photos')
+    p.add_argument('src', help='directory to scan for JPEG/PNG/WEBP images')
+    p.add_argument('-o', '--out', help='output directory (default: alongside)')
+    p.add_argument('-j', '--workers', type=int, default=WORKERS,
+                   help='worker processes (0 = run inline)')
+    p.add_argument('--size', type=parse_board_size, default=BOARD_SIZE,
+                   help="lines per side, or 'auto' (default: $BOARD_SIZE)")
+    p = sub.add_parser('track', help='record moves from a video or camera')
+    p.add_argument('source', help="video file, camera index, stream URL, "
+                                  "or '-' for MJPEG on stdin")
+    p.add_argument('-o', '--out', help='SGF file to keep up to date')
+    p.add_argument('--quiet-frames', type=int, default=8,
+                   help='unchanged frames before a position is committed')
+    p.add_argument('--size', type=parse_board_size, default=BOARD_SIZE,
+                   help="lines per side, or 'auto' (default: $BOARD_SIZE)")
+    p = sub.add_parser('bench', help='benchmark the pipeline on synthetic boards')
+    p.add_argument('-o', '--out', help='write results as JSON to this file')
+    p.add_argument('--compare', help='earlier results JSON to compare against')
+    p.add_argument('-n', '--repeats', type=int, default=3)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--tolerance', type=float, default=0.15,
+                   help='allowed slowdown before a case counts as a regression')
+    args = parser.parse_args(argv)
+    if args.command == 'convert':
+        return 1 if convert_dir(args.src, args.out, args.workers, args.size) else 0
+    if args.command == 'track':
+        track_video(args.source, args.out, quiet_frames=args.quiet_frames,
+                    size=args.size)
+        return 0
+    if args.command == 'bench':
+        results = run_bench(repeats=args.repeats, seed=args.seed)
+        if args.out:
+            with open(args.out, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as f:
+                base = json.load(f)
+            print()
+            return 1 if compare_bench(base, results, args.tolerance) else 0
+        return 0
+    serve()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())